@@ -19,7 +19,9 @@ def add_module_to_pythonpath():
 
 
 with add_module_to_pythonpath():
-    from utils import load_config, get_init_db_envs, create_init_db_file, get_extra_envs, normalize
+    from utils import (
+        load_config, get_init_db_envs, create_init_db_file, get_extra_envs, normalize, get_host_memory
+    )
 
 BASE_DIR = dirname(abspath(__file__))
 
@@ -27,8 +29,10 @@ ADMIN_TEMPLATE = re.compile(r'^[a-zA-Z_]*_admin$')
 
 SPECIAL_PARAM_TEMPLATE = re.compile(r'^{{(?P<get_command>[a-zA-Z_]*)}}$')
 
+NGINX_CACHE_DIR = '/var/cache/nginx/uwsgi'
+
 COMPOSE_TEMPLATE = {
-    'version': '2',
+    'version': '2.2',
     'services': {},
     'networks': {
         'default': {
@@ -49,6 +53,14 @@ PROJECT_TEMPLATE = {
     'environment': {}
 }
 
+PROJECT_RESOURCES = {
+    'cpu_shares': 1024,
+    'memory_share': 0.25,
+    'min_memory': 256,
+    'nofile': 65535,
+    'somaxconn': 1024
+}
+
 DOCKERFILE_TEMPLATE = '''FROM python:3.5-alpine
 
 MAINTAINER PavelEgorov
@@ -95,18 +107,28 @@ def prepare_for_redis(_, ctx, compose_conf_template):
     return compose_conf_template
 
 
-def prepare_for_nginx(config, _, compose_conf_template):
+def prepare_for_nginx(config, ctx, compose_conf_template):
     compose_conf = deepcopy(compose_conf_template)
     compose_conf['ports'] = [
         '{0}:{0}'.format(params['APPLICATION_PORT']) for params in config.values() if params.get('APPLICATION_PORT')
     ]
 
+    nofile = compose_conf.get('ulimits', {}).get('nofile', {}).get('soft')
+    somaxconn = compose_conf.get('sysctls', {}).get('net.core.somaxconn')
+    listen_options = ' backlog={}'.format(somaxconn) if somaxconn else ''
+
     nc = NginxConfig()
     nc.append(('user', 'nginx'))
     nc.append(('pid', '/var/run/nginx.pid'))
     nc.append(('worker_processes', '1'))
+    if nofile:
+        nc.append(('worker_rlimit_nofile', str(nofile)))
     nc.append(('error_log', 'stderr info'))
-    nc.append({'name': 'events', 'param': '', 'value': [('worker_connections', '1024')]})
+    nc.append({
+        'name': 'events',
+        'param': '',
+        'value': [('worker_connections', str(nofile // 2) if nofile else '1024')]
+    })
 
     http_conf = {
         'name': 'http',
@@ -121,9 +143,24 @@ def prepare_for_nginx(config, _, compose_conf_template):
         ]
     }
 
+    cached_services = _get_cached_services(config)
+    if cached_services:
+        ctx.run('mkdir -p nginx/cache')
+        compose_conf['volumes'].append('{}:{}:z'.format(join(BASE_DIR, 'nginx/cache'), NGINX_CACHE_DIR))
+        http_conf['value'].append(('uwsgi_cache_key', '$scheme$host$request_uri'))
+        for service_name in cached_services:
+            http_conf['value'].append((
+                'uwsgi_cache_path',
+                '{0}/{1} levels=1:2 keys_zone={1}:10m max_size={2} inactive=10m use_temp_path=off'.format(
+                    NGINX_CACHE_DIR, service_name, config[service_name].get('CACHE_SIZE') or '100m'
+                )
+            ))
+
     for service_name, params in config.items():
         if 'nginx' in params['DEPENDS_ON']:
             project_name = params['PROJECT_NAME']
+            path_ttls = _get_cache_path_ttls(params) if params.get('USE_CACHE') else []
+            root_ttl = dict(path_ttls).get('/', params.get('CACHE_TTL'))
 
             server_conf = {
                 'name': 'server',
@@ -135,22 +172,27 @@ def prepare_for_nginx(config, _, compose_conf_template):
                     {
                         'name': 'location',
                         'param': '/',
-                        'value': [
-                            ('uwsgi_pass', 'unix:///opt/sockets/{}.sock'.format(service_name)),
-                            ('include', '/opt/uwsgi_params')
-                        ]
+                        'value': _get_uwsgi_location(service_name, params, root_ttl)
                     },
                 ]
             }
 
+            for path, ttl in path_ttls:
+                if path != '/':
+                    server_conf['value'].append({
+                        'name': 'location',
+                        'param': path,
+                        'value': _get_uwsgi_location(service_name, params, ttl)
+                    })
+
             if params['USE_SSL']:
                 server_conf['value'].extend([
-                    ('listen', '{} ssl'.format(params['APPLICATION_PORT'])),
+                    ('listen', '{} ssl{}'.format(params['APPLICATION_PORT'], listen_options)),
                     ('ssl_certificate', '/opt/certs/{}'.format(params['SSL_CERT'])),
                     ('ssl_certificate_key', '/opt/certs/{}'.format(params['SSL_KEY'])),
                 ])
             else:
-                server_conf['value'].append(('listen', '{}'.format(params['APPLICATION_PORT'])))
+                server_conf['value'].append(('listen', '{}{}'.format(params['APPLICATION_PORT'], listen_options)))
 
             if params['USE_STATIC']:
                 server_conf['value'].append({
@@ -185,7 +227,12 @@ ADDITIONAL_SERVICES = {
             'volumes': ['{}:/var/lib/postgresql/data:z'.format(join(BASE_DIR, 'postgresql/data'))],
             'environment': {}
         },
-        'init_command': prepare_for_postgres
+        'init_command': prepare_for_postgres,
+        'resources': {
+            'cpu_shares': 2048,
+            'memory_share': 0.5,
+            'shm_share': 0.125
+        }
     },
     'redis': {
         'compose_conf': {
@@ -193,7 +240,11 @@ ADDITIONAL_SERVICES = {
             'image': 'redis:3-alpine',
             'volumes': ['{}:/data:z'.format(join(BASE_DIR, 'redis/data'))],
         },
-        'init_command': prepare_for_redis
+        'init_command': prepare_for_redis,
+        'resources': {
+            'cpu_shares': 512,
+            'memory_share': 0.125
+        }
     },
     'nginx': {
         'compose_conf': {
@@ -208,7 +259,13 @@ ADDITIONAL_SERVICES = {
                 '{}:/opt/media/:z'.format(join(BASE_DIR, 'media'))
             ]
         },
-        'init_command': prepare_for_nginx
+        'init_command': prepare_for_nginx,
+        'resources': {
+            'cpu_shares': 512,
+            'memory_share': 0.125,
+            'nofile': 65535,
+            'somaxconn': 1024
+        }
     },
 }
 
@@ -228,15 +285,22 @@ def create_docker_network(ctx):
 
 
 @task
-@load_config('deployment.ini')
+@load_config('deployment.ini', excess=frozenset(ADDITIONAL_SERVICES))
 def prepare_files(config, ctx):
     compose_body = deepcopy(COMPOSE_TEMPLATE)
     dependencies = set()
+    services_config = _load_additional_services_config()
+    project_resources = dict(
+        PROJECT_RESOURCES,
+        cpu_shares=max(PROJECT_RESOURCES['cpu_shares'] // len(config), 2),
+        memory_share=PROJECT_RESOURCES['memory_share'] / len(config)
+    )
 
     ctx.run('mkdir -p sockets')
 
     for service_name, params in config.items():
         dependencies.update(params.get('DEPENDS_ON', []).split(','))
+        resources_conf = _get_resources_conf(service_name, params, project_resources)
         compose_body['services'][service_name] = _init_project(
             ctx,
             service_name,
@@ -244,12 +308,18 @@ def prepare_files(config, ctx):
             normalize(params, {False: '', True: 'true'}),
             ADMIN_TEMPLATE.match(service_name)
         )
+        compose_body['services'][service_name].update(resources_conf)
 
     for dependency in dependencies:
         if dependency in ADDITIONAL_SERVICES:
             init_command = ADDITIONAL_SERVICES[dependency]['init_command']
-            compose_service_conf = init_command(config, ctx, ADDITIONAL_SERVICES[dependency]['compose_conf'])
-            compose_body['services'][dependency] = compose_service_conf
+            compose_conf_template = dict(
+                ADDITIONAL_SERVICES[dependency]['compose_conf'],
+                **_get_resources_conf(
+                    dependency, services_config.get(dependency, {}), ADDITIONAL_SERVICES[dependency]['resources']
+                )
+            )
+            compose_body['services'][dependency] = init_command(config, ctx, compose_conf_template)
 
     with open('docker-compose.json', 'w') as f:
         f.write(json.dumps(compose_body, indent=4, sort_keys=True))
@@ -286,6 +356,19 @@ def remove_images(ctx):
     ctx.run('docker rmi -f `docker images -a -q`', warn=True)
 
 
+@task
+def purge_cache(ctx, service=''):
+    if service and service not in _load_cached_services():
+        raise ValueError('Caching is not enabled for service "{}"'.format(service))
+
+    ctx.run(
+        '/opt/python/bin/docker-compose -f docker-compose.json exec -T nginx sh -c "rm -rf {}/*"'.format(
+            join(NGINX_CACHE_DIR, service or '*')
+        ),
+        warn=True
+    )
+
+
 def _init_project(ctx, service_name, project_name, params, is_admin):
     project_settings = deepcopy(PROJECT_TEMPLATE)
 
@@ -334,6 +417,123 @@ def _init_project(ctx, service_name, project_name, params, is_admin):
     return project_settings
 
 
+def _get_resources_conf(service_name, params, defaults):
+    host_memory = get_host_memory()
+
+    resources_conf = {
+        'cpu_shares': _get_number_param(service_name, params, 'CPU_SHARES') or defaults['cpu_shares'],
+        'mem_limit': params.get('MEM_LIMIT') or _to_megabytes(
+            host_memory * defaults['memory_share'], defaults.get('min_memory', 64)
+        )
+    }
+
+    cpus = _get_number_param(service_name, params, 'CPUS', float)
+    if cpus:
+        resources_conf['cpus'] = cpus
+
+    if params.get('CPUSET'):
+        resources_conf['cpuset'] = params['CPUSET']
+
+    if params.get('SHM_SIZE') or defaults.get('shm_share'):
+        resources_conf['shm_size'] = params.get('SHM_SIZE') or _to_megabytes(host_memory * defaults['shm_share'])
+
+    nofile = _get_number_param(service_name, params, 'NOFILE') or defaults.get('nofile')
+    if nofile:
+        resources_conf['ulimits'] = {'nofile': {'soft': nofile, 'hard': nofile}}
+
+    sysctls = {}
+    somaxconn = _get_number_param(service_name, params, 'SOMAXCONN') or defaults.get('somaxconn')
+    if somaxconn:
+        sysctls['net.core.somaxconn'] = str(somaxconn)
+    tcp_tw_reuse = params.get('TCP_TW_REUSE') or defaults.get('tcp_tw_reuse')
+    if tcp_tw_reuse not in (None, True):
+        raise ValueError('tcp_tw_reuse in [{}] section of deployment.ini must be "true" or "false", got "{}"'.format(
+            service_name, tcp_tw_reuse
+        ))
+    if tcp_tw_reuse:
+        sysctls['net.ipv4.tcp_tw_reuse'] = '1'
+    if sysctls:
+        resources_conf['sysctls'] = sysctls
+
+    return resources_conf
+
+
+def _get_number_param(service_name, params, key, cast=int):
+    value = params.get(key)
+    if not value:
+        return None
+
+    try:
+        if isinstance(value, bool):
+            raise ValueError
+        return cast(value)
+    except ValueError:
+        raise ValueError('{} in [{}] section of deployment.ini must be a number, got "{}"'.format(
+            key.lower(), service_name, value
+        ))
+
+
+def _to_megabytes(size, minimum=64):
+    return '{}m'.format(max(int(size) // 2 ** 20, minimum))
+
+
+def _get_uwsgi_listen(params):
+    return params.get('SOMAXCONN') or PROJECT_RESOURCES['somaxconn']
+
+
+def _get_cached_services(config):
+    return [
+        service_name for service_name, params in config.items()
+        if 'nginx' in params['DEPENDS_ON'] and params.get('USE_CACHE')
+    ]
+
+
+@load_config('deployment.ini', excess=frozenset(ADDITIONAL_SERVICES))
+def _load_cached_services(config, _):
+    return _get_cached_services(config)
+
+
+@load_config('deployment.ini', target=frozenset(ADDITIONAL_SERVICES))
+def _load_additional_services_config(config, _):
+    return config
+
+
+def _get_uwsgi_location(service_name, params, ttl):
+    location = [
+        ('uwsgi_pass', 'unix:///opt/sockets/{}.sock'.format(service_name)),
+        ('include', '/opt/uwsgi_params')
+    ]
+
+    if params.get('USE_CACHE'):
+        bypass = ' '.join(
+            ['$cookie_{}'.format(cookie) for cookie in (params.get('CACHE_BYPASS_COOKIES') or '').split(',') if cookie]
+            + ['$http_authorization']
+        )
+        location.extend([
+            ('uwsgi_cache', service_name),
+            ('uwsgi_cache_valid', '200 301 302 {}'.format(ttl or '1s')),
+            ('uwsgi_cache_lock', 'on'),
+            ('uwsgi_cache_use_stale', 'updating error timeout'),
+            ('uwsgi_cache_bypass', bypass),
+            ('uwsgi_no_cache', bypass),
+            ('add_header', 'X-Cache-Status $upstream_cache_status'),
+        ])
+
+    return location
+
+
+def _get_cache_path_ttls(params):
+    path_ttls = []
+    for path_ttl in (params.get('CACHE_PATH_TTLS') or '').split(','):
+        path_ttl = path_ttl.strip()
+        if path_ttl:
+            path, separator, ttl = (part.strip() for part in path_ttl.rpartition(':'))
+            if not separator:
+                path, ttl = ttl, params.get('CACHE_TTL')
+            path_ttls.append((path, ttl))
+    return path_ttls
+
+
 def _get_admin_entrypoint(service_name, params):
     result = 'sh -c "{}"'
     commands = [
@@ -345,8 +545,8 @@ def _get_admin_entrypoint(service_name, params):
             params['ADMIN_USER_NAME'], params['ADMIN_EMAIL'], params['ADMIN_PASSWORD']
         ),
         'python manage.py shell && ',
-        'uwsgi --socket /main_project/sockets/{}.sock --module {}.wsgi:application --master'.format(
-            service_name, params['PROJECT_NAME']
+        'uwsgi --socket /main_project/sockets/{}.sock --module {}.wsgi:application --master --listen {}'.format(
+            service_name, params['PROJECT_NAME'], _get_uwsgi_listen(params)
         )
     ]
     return result.format(''.join(commands))
@@ -359,9 +559,11 @@ def _get_entrypoint(service_name, params):
         commands.append('python manage.py migrate --fake-initial --noinput && ')
     if params['USE_STATIC']:
         commands.append('python manage.py collectstatic --clear --noinput && ')
-    commands.append('uwsgi --socket /main_project/sockets/{}.sock --module {}.wsgi:application --master'.format(
-        service_name, params['PROJECT_NAME']
-    ))
+    commands.append(
+        'uwsgi --socket /main_project/sockets/{}.sock --module {}.wsgi:application --master --listen {}'.format(
+            service_name, params['PROJECT_NAME'], _get_uwsgi_listen(params)
+        )
+    )
     return result.format(''.join(commands))
 
 
@@ -1,4 +1,5 @@
 import configparser
+import os
 import random
 from copy import deepcopy, copy
 from functools import wraps
@@ -49,6 +50,10 @@ def get_extra_envs():
     }
 
 
+def get_host_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
 def get_prepared_params(params):
     return '-e ' + ' -e '.join('{}="{}"'.format(name, value) for name, value in params.items())
 
@@ -160,6 +160,11 @@ def remove_images():
         run('/opt/python/bin/invoke remove_images')
 
 
+def purge_cache(service=''):
+    with cd(get_project_dir()):
+        run('/opt/python/bin/invoke purge_cache{}'.format(' --service={}'.format(service) if service else ''))
+
+
 @contextmanager
 def disconnect():
     yield